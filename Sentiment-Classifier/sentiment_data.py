@@ -44,7 +44,7 @@ def read_sentiment_examples(infile: str) -> List[SentimentExample]:
                 # Slightly more robust to reading bad output than int(fields[0])
                 label = 0 if "0" in fields[0] else 1
                 sent = fields[1]
-            tokenized_cleaned_sent = list(filter(lambda x: x != '', sent.rstrip().split(" ")))
+            tokenized_cleaned_sent = [word for word in sent.rstrip().split(" ") if word]
             exs.append(SentimentExample(tokenized_cleaned_sent, label))
     f.close()
     return exs